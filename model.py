@@ -1,3 +1,5 @@
+import os
+import cv2
 import tqdm
 import torch
 import torch.nn as nn
@@ -5,10 +7,12 @@ import numpy as np
 from PIL import Image
 from torch.cuda import is_available
 from torch.utils.data import DataLoader, Dataset
-from transformers import ViTFeatureExtractor, ViTForImageClassification, AdamW
+from transformers import AutoImageProcessor, ViTForImageClassification, AdamW
 from sklearn.metrics import classification_report
 from utils import get_images_classification_result
 
+IMAGE_SIZE = 224
+
 
 class SpamDataset(Dataset):
     def __init__(self, label_json: dict, train=True, train_ratio=0.7):
@@ -17,85 +21,197 @@ class SpamDataset(Dataset):
         :param train: if train is True, use for train dataset
         :param train_ratio: train test ratio
         """
-        self.contents = self.split_dataset_with_balancing(label_json, train, train_ratio)
+        self.paths, self.labels = self.split_dataset_with_balancing(label_json, train, train_ratio)
+        self.images = self.prepare_cache(f'cache_{"train" if train else "test"}')
 
     def __len__(self):
-        return len(self.contents)
+        return len(self.paths)
 
     def __getitem__(self, index):
-        return self.contents[index]
+        return self.images[index], self.labels[index]
+
+    @staticmethod
+    def decode_image(img_path):
+        image = cv2.imread(img_path, cv2.IMREAD_COLOR)
+        if image is None:
+            pil_image = Image.open(img_path)
+            if pil_image.mode != 'RGB':
+                pil_image = pil_image.convert('RGB')
+            return np.asarray(pil_image)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def prepare_cache(self, cache_prefix):
+        """
+        Decode + resize every image once and memmap the packed uint8 array,
+        so later epochs read straight from the page cache instead of
+        re-decoding JPEGs. The ordered path list is saved next to the
+        pixel cache and compared on load, so relabeling in labeling.py
+        (which moves images between spam_images class folders) or new
+        images trigger a rebuild instead of reusing stale pixels.
+        """
+        images_path = f'{cache_prefix}_images.npy'
+        paths_path = f'{cache_prefix}_paths.npy'
+        shape = (len(self.paths), IMAGE_SIZE, IMAGE_SIZE, 3)
+        if not self.cache_is_valid(images_path, paths_path):
+            cache = np.memmap(images_path, dtype=np.uint8, mode='w+', shape=shape)
+            for index, img_path in enumerate(self.paths):
+                image = self.decode_image(img_path)
+                cache[index] = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+            cache.flush()
+            np.save(paths_path, self.paths)
+        return np.memmap(images_path, dtype=np.uint8, mode='r', shape=shape)
+
+    def cache_is_valid(self, images_path, paths_path):
+        if not os.path.exists(images_path) or not os.path.exists(paths_path):
+            return False
+        cached_paths = np.load(paths_path, allow_pickle=True)
+        return len(cached_paths) == len(self.paths) and bool((cached_paths == self.paths).all())
 
     def split_dataset_with_balancing(self, label_json, train, train_ratio):
-        balance_dict = dict()
-        for img_path, label in label_json.items():
-            balance_dict.setdefault(label, list()).append(img_path)
-        contents = list()
-        for label, img_paths in balance_dict.items():
-            split_index = int(len(img_paths) * train_ratio)
-            if train:
-                _img_paths = img_paths[:split_index]
-            else:
-                _img_paths = img_paths[split_index:]
-            for img_path in _img_paths:
-                contents.append((img_path, int(label)-1))
-        return contents
+        paths = np.array(list(label_json.keys()), dtype=object)
+        labels = np.array([int(label) for label in label_json.values()], dtype=np.int64)
+        order = np.argsort(labels, kind='stable')
+        paths, labels = paths[order], labels[order]
+        boundaries = np.searchsorted(labels, np.unique(labels), side='left')
+        take = list()
+        for lo, hi in zip(boundaries, np.append(boundaries[1:], len(labels))):
+            split_index = lo + int((hi - lo) * train_ratio)
+            take.append(np.arange(lo, split_index) if train else np.arange(split_index, hi))
+        take = np.concatenate(take) if take else np.array([], dtype=np.int64)
+        return paths[take], (labels[take] - 1).astype(np.int8)
+
+
+def collate_batch(batch):
+    images, labels = zip(*batch)
+    pixel_values = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2)
+    return pixel_values.contiguous(memory_format=torch.channels_last), torch.tensor(labels)
+
+
+def normalization_constants(image_processor, device):
+    image_mean = torch.tensor(image_processor.image_mean, device=device).view(1, -1, 1, 1)
+    image_std = torch.tensor(image_processor.image_std, device=device).view(1, -1, 1, 1)
+    return image_mean, image_std
+
+
+def normalize_pixel_values(pixel_values, image_mean, image_std):
+    return pixel_values.float().div_(255).sub_(image_mean).div_(image_std)
+
+
+class CUDAPrefetcher:
+    """
+    Issue the next batch's H2D copy on a side CUDA stream so the
+    transfer overlaps with the current batch's compute on the default
+    stream. Batches must come from a pin_memory DataLoader.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self.preload(iterator)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for tensor in batch:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(iterator)
+            yield batch
+
+    def preload(self, iterator):
+        try:
+            pixel_values, labels = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return (pixel_values.to(self.device, non_blocking=True),
+                    labels.to(self.device, dtype=torch.long, non_blocking=True))
+
+
+def device_batches(batches, device):
+    if device == 'cuda':
+        return CUDAPrefetcher(batches, device)
+    return ((pixel_values.to(device), labels.to(device, dtype=torch.long))
+            for pixel_values, labels in batches)
 
 
 def train_image_spam_classifier(model_checkpoint, device, label_json):
     train_dataset = SpamDataset(label_json)
-    train_dataloader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    feature_extractor = ViTFeatureExtractor.from_pretrained(model_checkpoint)
+    image_processor = AutoImageProcessor.from_pretrained(model_checkpoint, use_fast=True)
+    train_dataloader = DataLoader(train_dataset,
+                                  batch_size=16,
+                                  shuffle=True,
+                                  num_workers=os.cpu_count(),
+                                  persistent_workers=True,
+                                  pin_memory=True,
+                                  collate_fn=collate_batch)
     model = ViTForImageClassification.from_pretrained(model_checkpoint,
                                                       num_labels=3)
     optim = AdamW(model.parameters(), lr=2e-5)
     criterion = nn.CrossEntropyLoss()
-    model.to(device)
+    model.to(device, memory_format=torch.channels_last)
+    model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
     model.train()
+    image_mean, image_std = normalization_constants(image_processor, device)
     num_epochs, max_norm = 5, 5
     for epoch in range(num_epochs):
-        losses = []
+        loss_sum = torch.zeros((), device=device)
+        num_steps = 0
         train_batches = tqdm.tqdm(train_dataloader, leave=True)
-        for img_paths, labels in train_batches:
+        train_batches.set_description(f'Epoch : {epoch}')
+        for pixel_values, target in device_batches(train_batches, device):
             optim.zero_grad()
-            images = [Image.open(img_path).convert('RGB') for img_path in img_paths]
-            inputs = feature_extractor(images=images, do_resize=True, size=500, return_tensors="pt").to(device)
-            outputs = model(**inputs)
-            target = torch.LongTensor(labels).to(device)
-            loss = criterion(outputs.logits, target)
+            pixel_values = normalize_pixel_values(pixel_values, image_mean, image_std)
+            with torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=device == 'cuda'):
+                outputs = model(pixel_values=pixel_values)
+                loss = criterion(outputs.logits, target)
             loss.backward()
-            torch.nn.utils.clip_grad_norm(model.parameters(),
-                                          max_norm=max_norm)
+            torch.nn.utils.clip_grad_norm_(model.parameters(),
+                                           max_norm=max_norm)
             optim.step()
-            loss_val = round(loss.item(), 3)
-            losses.append(loss_val)
-            train_batches.set_description(f'Epoch : {epoch}')
-            loss_mean = round(sum(losses) / len(losses), 3)
-            train_batches.set_postfix(loss=loss_mean)
-        model_checkpoint = f'vit_epochs_{epoch}_loss_{loss_mean}.pt'
-        model.save_pretrained(model_checkpoint)
+            loss_sum += loss.detach()
+            num_steps += 1
+            if num_steps % 10 == 0:
+                loss_mean = round((loss_sum / num_steps).item(), 3)
+                train_batches.set_postfix(loss=loss_mean)
+        loss_mean = round((loss_sum / num_steps).item(), 3)
+    model_checkpoint = f'vit_epochs_{num_epochs - 1}_loss_{loss_mean}.pt'
+    model.save_pretrained(model_checkpoint)
     return model_checkpoint
 
 
 def evaluate_image_spam_classifier(model_checkpoint, device, label_json):
     test_dataset = SpamDataset(label_json, train=False)
-    test_dataloader = DataLoader(test_dataset, batch_size=16, shuffle=True)
+    processor_checkpoint = 'google/vit-base-patch16-224-in21k'
+    image_processor = AutoImageProcessor.from_pretrained(processor_checkpoint, use_fast=True)
+    test_dataloader = DataLoader(test_dataset,
+                                 batch_size=16,
+                                 shuffle=True,
+                                 num_workers=os.cpu_count(),
+                                 persistent_workers=True,
+                                 pin_memory=True,
+                                 collate_fn=collate_batch)
     test_batches = tqdm.tqdm(test_dataloader)
-    fe_checkpoint = 'google/vit-base-patch16-224-in21k'
-    feature_extractor = ViTFeatureExtractor.from_pretrained(fe_checkpoint)
     model = ViTForImageClassification.from_pretrained(model_checkpoint,
                                                       num_labels=3)
-    model.to(device)
+    model.to(device, memory_format=torch.channels_last)
     model.eval()
-    true_labels, pred_labels = [], []
-    for img_paths, labels in test_batches:
-        images = [Image.open(img_path).convert('RGB') for img_path in img_paths]
-        inputs = feature_extractor(images=images, do_resize=True, size=500, return_tensors='pt').to(device)
-        outputs = model(**inputs)
-        preds = outputs.logits.argmax(-1)
-        preds = preds.detach().cpu().numpy() if is_available() else preds.numpy()
-        true_labels.extend(labels.numpy())
-        pred_labels.extend(preds)
-    true_labels, pred_labels = map(np.array, (true_labels, pred_labels))
+    image_mean, image_std = normalization_constants(image_processor, device)
+    true_chunks, pred_chunks = [], []
+    with torch.inference_mode():
+        for pixel_values, labels in test_batches:
+            pixel_values = pixel_values.to(device, non_blocking=True)
+            pixel_values = normalize_pixel_values(pixel_values, image_mean, image_std)
+            outputs = model(pixel_values=pixel_values)
+            pred_chunks.append(outputs.logits.argmax(-1))
+            true_chunks.append(labels)
+    true_labels = torch.cat(true_chunks).numpy()
+    pred_labels = torch.cat(pred_chunks).cpu().numpy()
     report = classification_report(true_labels,
                                    pred_labels,
                                    target_names=['non-spam',
@@ -108,6 +224,9 @@ def evaluate_image_spam_classifier(model_checkpoint, device, label_json):
 if __name__ == "__main__":
     label_json = get_images_classification_result()
     device = 'cuda' if is_available() else 'cpu'
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     model_checkpoint = 'google/vit-base-patch16-224-in21k'
 
     # Training